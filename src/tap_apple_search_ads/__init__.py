@@ -1,24 +1,59 @@
+import atexit
 import datetime
+import functools
+import io
 import json
+import os
 import pathlib
-import shelve
+import pickle
 import sys
+import threading
 import time
-from typing import Any, Dict, List, Mapping, MutableMapping, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from importlib.resources import files
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Union,
+)
 
-import pkg_resources
-import pytz
 import singer
 from singer import metadata
 import singer.utils as singer_utils
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 from tap_apple_search_ads import config as tap_config
-from tap_apple_search_ads.api import auth, campaign, campaign_level_reports, impression_share_reports
+from tap_apple_search_ads.api import (
+    API_DATE_FORMAT,
+    auth,
+    campaign,
+    campaign_level_reports,
+    impression_share_reports,
+)
 from tap_apple_search_ads.api.auth import client_secret
 from tap_apple_search_ads.schema.from_file import api as schema
 
 logger = singer.get_logger()
 
+STDOUT_BUFFER_SIZE = 1 << 20
+
+# records are written to stdout in batches, one lock acquisition per batch
+RECORD_BATCH_SIZE = 100
+
+# guards stdout and the shared state dict, streams are synced in parallel
+output_lock = threading.RLock()
+
 REQUIRED_CONFIG_KEYS: List[str] = [
     # ClientSecret
     "client_id",
@@ -28,16 +63,16 @@ REQUIRED_CONFIG_KEYS: List[str] = [
     "org_id",
 ]
 
-STREAMS = [
+STREAMS: Tuple[str, ...] = (
     "campaign",
     "campaign_flat",
     "campaign_level_reports",
     "campaign_level_reports_extended_spend_row",
     "campaign_level_reports_extended_spend_row_flat",
-    "impression_share_reports"
-]
+    "impression_share_reports",
+)
 
-cache: Optional[shelve.Shelf] = None
+cache: Optional[Dict[str, Any]] = None
 
 
 def main():
@@ -51,50 +86,82 @@ def main():
         else:
             state = {}
 
+        sys.stdout = buffered_stdout()
+
         return do_sync(args.config, args.catalog, state)
 
 
-def do_discover() -> int:
-    result: Dict[str, List[Dict[str, Any]]] = {"streams": []}
+def buffered_stdout() -> io.TextIOWrapper:
+    """stdout with a large buffer. Records are written without flushing, the buffer
+    is flushed by every singer.write_state (singer flushes after each message it
+    writes) and at interpreter exit.
+    """
+
+    sys.stdout.flush()
+    stream = open(
+        sys.stdout.fileno(), "wb", buffering=STDOUT_BUFFER_SIZE, closefd=False
+    )
+    return io.TextIOWrapper(stream, encoding="utf-8", line_buffering=False)
 
-    for stream in STREAMS:
-        stream_schema = load_schema(stream)
 
-        result["streams"].append(
+def do_discover() -> int:
+    stream_metadata = [
+        {
+            "metadata": {
+                "selected": False,
+            },
+            "breadcrumb": [],
+        },
+    ]
+
+    result: Dict[str, List[Dict[str, Any]]] = {
+        "streams": [
             {
                 "stream": stream,
                 "tap_stream_id": stream,
-                "schema": stream_schema,
-                "metadata": [
-                    {
-                        "metadata": {
-                            "selected": False,
-                        },
-                        "breadcrumb": [],
-                    },
-                ],
+                "schema": load_schema(stream),
+                "metadata": stream_metadata,
             }
-        )
+            for stream in STREAMS
+        ]
+    }
 
-    json.dump(result, sys.stdout, indent=2)
+    write_catalog(result)
 
     return 0
 
 
+def write_catalog(catalog: Dict[str, Any]) -> None:
+    if orjson is not None:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(orjson.dumps(catalog, option=orjson.OPT_INDENT_2))
+        sys.stdout.buffer.flush()
+        return
+
+    sys.stdout.write(json.dumps(catalog, indent=2))
+
+
+@functools.lru_cache(maxsize=None)
 def load_schema(stream_name: str) -> Dict[str, Any]:
-    schemas_directory = pkg_resources.resource_filename(__name__, "schemas")
+    schemas_directory = str(files(__name__) / "schemas")
 
-    loader = schema.Loader(schemas_directory)
-    resolver = schema.Resolver(loader)
-    facade = schema.Facade(resolver)
+    facade = get_facade(schemas_directory)
 
     schema_loader = getattr(facade, stream_name)
 
     return schema_loader()
 
 
+@functools.lru_cache(maxsize=1)
+def get_facade(schemas_directory: str) -> schema.Facade:
+    # single Loader per directory, so JSON files are read and parsed only once
+    loader = schema.Loader(schemas_directory)
+    resolver = schema.Resolver(loader)
+    return schema.Facade(resolver)
+
+
 def do_sync(config: Dict[str, Any], catalog: singer.Catalog, state: Dict[str, Any]):
-    now = datetime.datetime.now(tz=pytz.utc)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
     timestamp = int(now.timestamp())
 
     config_ = tap_config.Authentication.from_mapping(config)
@@ -102,8 +169,8 @@ def do_sync(config: Dict[str, Any], catalog: singer.Catalog, state: Dict[str, An
     auth_objects = set_up_authentication(timestamp, config_)
 
     if config_.local_caching:
-        cache = get_or_create_cache(config_.tmp_dir, config_.auth_cache_file)
-        auth_objects = add_caching(*auth_objects, cache=cache)
+        auth_cache = get_or_create_cache(config_.tmp_dir, config_.auth_cache_file)
+        auth_objects = add_caching(*auth_objects, cache=auth_cache)
 
     cs, at, rh = auth_objects
     private_key = load_private_key(config)
@@ -114,11 +181,54 @@ def do_sync(config: Dict[str, Any], catalog: singer.Catalog, state: Dict[str, An
         "start_time": config_.start_time,
         "end_time": config_.end_time,
         "selector": config_.selector,
+        "sync_start_time": now,
+        "default_end_time": now - datetime.timedelta(days=1),
     }
 
+    # streams built from the same API endpoint are synced one after another in a
+    # single task, so they can share fetched data; tasks run in parallel and share
+    # state and additional_params, stream handlers must not modify the latter
+    tasks: Dict[str, List[Tuple[str, Dict[str, Any], List[str]]]] = {}
+
     for stream in catalog.streams:
         stream_name = stream.tap_stream_id
-        sync_stream(stream_name, stream, state, request_headers_value, additional_params)
+        # metadata.to_map converts metadata to dict of tuples of breadcrumb to
+        # actual metadata objects. Empty tuple means no breadcrumb, means the
+        # whole stream
+        stream_metadata = metadata.to_map(stream.metadata).get((), {})
+
+        if not stream_metadata.get("selected", False):
+            logger.info("%s: Skipped sync", stream_name)
+            continue
+
+        # fail before any stream is synced, tasks only report errors once all of
+        # them have finished
+        if stream_name not in STREAM_HANDLERS:
+            raise TapAppleSearchAdsException("Unknown stream: [{}]".format(stream_name))
+
+        source = STREAM_SOURCES.get(stream_name, stream_name)
+        tasks.setdefault(source, []).append(
+            (
+                stream_name,
+                stream.schema.to_dict(),
+                stream_metadata.get("key-properties", []),
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=config_.max_sync_workers) as executor:
+        futures = [
+            executor.submit(
+                sync_streams,
+                streams,
+                state,
+                request_headers_value,
+                additional_params,
+            )
+            for streams in tasks.values()
+        ]
+
+        for future in futures:
+            future.result()
 
     logger.info("Done syncing.")
 
@@ -131,7 +241,9 @@ def load_private_key(config: Mapping[str, str]) -> str:
 
     elif "private_key_file" in config:
         private_key_file = config["private_key_file"]
-        private_key = auth.utils.read_private_key_from_file(private_key_file)
+        private_key = read_private_key(
+            private_key_file, os.path.getmtime(private_key_file)
+        )
 
     else:
         raise TapAppleSearchAdsException("Missing private key configuration parameters")
@@ -139,6 +251,12 @@ def load_private_key(config: Mapping[str, str]) -> str:
     return private_key
 
 
+@functools.lru_cache(maxsize=4)
+def read_private_key(private_key_file: str, modification_time: float) -> str:
+    # modification_time is part of the cache key only, a changed file is re-read
+    return auth.utils.read_private_key_from_file(private_key_file)
+
+
 class TapAppleSearchAdsException(Exception):
     pass
 
@@ -161,9 +279,10 @@ def set_up_authentication(
     return client_secret_, access_token, request_headers
 
 
-def get_or_create_cache(cache_dir: str, cache_file: str) -> shelve.Shelf:
+def get_or_create_cache(cache_dir: str, cache_file: str) -> Dict[str, Any]:
     global cache
-    if cache:
+    # an empty dict is a valid, already loaded cache
+    if cache is not None:
         return cache
 
     cache_dir_ = pathlib.Path(cache_dir)
@@ -175,11 +294,47 @@ def get_or_create_cache(cache_dir: str, cache_file: str) -> shelve.Shelf:
 
     cache_file_ = cache_dir_ / cache_file
 
-    cache = shelve.open(cache_file_.as_posix())
+    cache = load_cache(cache_file_)
+    atexit.register(save_cache, cache, cache_file_)
 
     return cache
 
 
+def load_cache(cache_file: pathlib.Path) -> Dict[str, Any]:
+    if not cache_file.exists():
+        return {}
+
+    try:
+        with open(cache_file, "rb") as stream:
+            data = pickle.load(stream)
+    except Exception as e:
+        logger.warning(
+            "Cache file [%s] could not be read ([%s]), starting with an empty cache",
+            cache_file.as_posix(),
+            e,
+        )
+        return {}
+
+    if not isinstance(data, dict):
+        logger.warning(
+            "Cache file [%s] does not contain a mapping, starting with an empty cache",
+            cache_file.as_posix(),
+        )
+        return {}
+
+    return data
+
+
+def save_cache(cache: Mapping[str, Any], cache_file: pathlib.Path) -> None:
+    # write to a temporary file first so an interrupted write keeps the old cache
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+
+    with open(tmp_file, "wb") as stream:
+        pickle.dump(dict(cache), stream)
+
+    os.replace(tmp_file, cache_file)
+
+
 def add_caching(
     client_secret: auth.ClientSecret,
     access_token: auth.AccessToken,
@@ -193,29 +348,38 @@ def add_caching(
     )
 
 
-def sync_stream(
-    stream_name: str,
-    stream: singer.CatalogEntry,
+def sync_streams(
+    streams: List[Tuple[str, Dict[str, Any], List[str]]],
     state: Dict[str, Any],
     headers: auth.RequestHeadersValue,
     additional: Dict[str, Any],
 ) -> None:
-    stream_metadata = metadata.to_map(stream.metadata)
-    # metadata.to_map converts metadata to dict of tuples of breadcrumb to actual
-    # metadata objects. Empty tuple means no breadcrumb, means the whole stream
-    stream_selected = stream_metadata.get((), {}).get("selected", False)
+    # data fetched by one stream of the task and reused by the following ones, it
+    # is released as soon as the task ends
+    task_additional = dict(additional, fetched={})
+
+    for stream_name, stream_schema, key_properties in streams:
+        sync_stream(
+            stream_name, stream_schema, key_properties, state, headers, task_additional
+        )
 
-    if not stream_selected:
-        logger.info("%s: Skipped sync", stream_name)
-        return
 
+def sync_stream(
+    stream_name: str,
+    stream_schema: Dict[str, Any],
+    key_properties: List[str],
+    state: Dict[str, Any],
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> None:
     start_time = time.monotonic()
     logger.info("%s: Starting sync", stream_name)
 
-    singer.write_schema(stream_name, stream.schema.to_dict(), stream_metadata.get((), {}).get("key-properties", []))
+    with output_lock:
+        singer.write_schema(stream_name, stream_schema, key_properties)
 
     state = sync_concrete_stream(state, stream_name, headers, additional)
-    singer.write_state(state)
+    write_state(state)
 
     records_count = singer.get_bookmark(state, stream_name, 'latestRecordCount', default=0)
     end_time = time.monotonic() - start_time
@@ -227,91 +391,246 @@ def sync_stream(
 def sync_concrete_stream(
     state: Dict[str, Any], stream_name: str, headers: auth.RequestHeadersValue, additional: Dict[str, Any]
 ) -> Dict[str, Any]:
-    if stream_name == "campaign":
-        campaing_records = campaign.sync(headers)
-        for record in campaing_records:
-            singer.write_record(stream_name, record)
+    handler = STREAM_HANDLERS.get(stream_name)
+    if handler is None:
+        raise TapAppleSearchAdsException("Unknown stream: [{}]".format(stream_name))
+
+    return handler(state, stream_name, headers, additional)
+
+
+class RecordWriter:
+    def __init__(self, stream_name: str, batch_size: int = RECORD_BATCH_SIZE) -> None:
+        """RecordWriter writes RECORD messages of a single stream to stdout. The
+        message envelope is formatted once per stream and only the record is
+        serialized per call. Records are written in batches under output_lock and,
+        unlike singer.write_record, stdout is not flushed after every record.
+
+        Parameters
+        ----------
+        stream_name : str
+            name of the stream records belong to
+        batch_size : int, optional
+            number of records collected before writing them out, by default
+            RECORD_BATCH_SIZE
+        """
+
+        self.prefix = (
+            '{"type": "RECORD", "stream": ' + json.dumps(stream_name) + ', "record": '
+        )
+        self.batch_size = batch_size
+        self.lines: List[str] = []
 
-        return state
+    def write(self, record: Dict[str, Any]) -> None:
+        lines = self.lines
+        # same serialization as singer.write_record, NaN and Infinity raise
+        lines.append(self.prefix + json.dumps(record, allow_nan=False) + "}\n")
 
-    elif stream_name == "campaign_flat":
-        campaing_records = campaign.sync(headers)
-        for record in campaing_records:
-            record = campaign.to_schema(record)
-            singer.write_record(stream_name, record)
+        if len(lines) >= self.batch_size:
+            self.flush()
 
-        return state
+    def flush(self) -> None:
+        if not self.lines:
+            return
 
-    elif stream_name == "campaign_level_reports":
-        reports_records = campaign_level_reports.sync(
-            headers,
-            additional["start_time"],
-            additional["end_time"],
-            additional["selector"],
-        )
-        for record in reports_records:
-            singer.write_record(stream_name, record)
+        with output_lock:
+            sys.stdout.write("".join(self.lines))
 
-        return state
+        self.lines.clear()
 
-    elif stream_name == "campaign_level_reports_extended_spend_row":
-        reports_records = campaign_level_reports.sync_extended_spend_row(
-            headers,
-            additional["start_time"],
-            additional["end_time"],
-            additional["selector"],
-        )
-        for record in reports_records:
-            singer.write_record(stream_name, record)
 
-        return state
+def emit(
+    stream_name: str,
+    records: Iterable[Dict[str, Any]],
+    transform: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+) -> None:
+    writer = RecordWriter(stream_name)
+    write_record = writer.write
+
+    if transform is None:
+        for record in records:
+            write_record(record)
+    else:
+        for record in records:
+            write_record(transform(record))
+
+    writer.flush()
+
+
+def write_bookmark(
+    state: Dict[str, Any], stream_name: str, key: str, value: Any
+) -> Dict[str, Any]:
+    with output_lock:
+        return singer.write_bookmark(state, stream_name, key, value)
+
+
+def write_state(state: Dict[str, Any]) -> None:
+    with output_lock:
+        singer.write_state(state)
+
+
+def sync_campaign(
+    state: Dict[str, Any],
+    stream_name: str,
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> Dict[str, Any]:
+    emit(stream_name, campaign.sync(headers))
+    return state
 
-    elif stream_name == "campaign_level_reports_extended_spend_row_flat":
-        reports_records = campaign_level_reports.sync_extended_spend_row(
+
+def sync_campaign_flat(
+    state: Dict[str, Any],
+    stream_name: str,
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> Dict[str, Any]:
+    emit(stream_name, campaign.sync(headers), campaign.to_schema)
+    return state
+
+
+def report_rows(
+    headers: auth.RequestHeadersValue, additional: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Campaign level report rows, fetched once per sync_streams task. Raw, extended
+    spend row and flat extended spend row streams are all built from the same
+    report, so selecting several of them issues a single API request.
+    """
+
+    fetched = additional["fetched"]
+
+    if "campaign_level_reports" not in fetched:
+        fetched["campaign_level_reports"] = campaign_level_reports.sync(
             headers,
             additional["start_time"],
             additional["end_time"],
             additional["selector"],
         )
-        for record in reports_records:
-            singer.write_record(stream_name, campaign_level_reports.flatten(record))
 
-        return state
+    return fetched["campaign_level_reports"]
 
-    elif stream_name == "impression_share_reports":
 
-        # get current max replication value from state if available, otherwise default to config value
-        current_bookmark_value = singer.get_bookmark(
-            state,
-            stream_name,
-            'date',
-            default=None
-        )
+def sync_campaign_level_reports(
+    state: Dict[str, Any],
+    stream_name: str,
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> Dict[str, Any]:
+    emit(stream_name, report_rows(headers, additional))
+    return state
 
-        if current_bookmark_value is not None:
-            additional['start_time'] = singer_utils.strptime_to_utc(current_bookmark_value) + datetime.timedelta(days=1)
 
-        if additional['end_time'] is None:
-            additional['end_time'] = datetime.datetime.today() - datetime.timedelta(days=1)
+def sync_extended_spend_row(
+    state: Dict[str, Any],
+    stream_name: str,
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> Dict[str, Any]:
+    reports_records = campaign_level_reports.extended_spend_rows(
+        report_rows(headers, additional)
+    )
+    emit(stream_name, reports_records)
+    return state
 
-        logger.info(f"Start date: {additional['start_time']}")
 
-        reports_records = impression_share_reports.sync(
-            headers,
-            additional["start_time"],
-            additional["end_time"],
-            "custom_reports_selector",
-        )
+def sync_extended_spend_row_flat(
+    state: Dict[str, Any],
+    stream_name: str,
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> Dict[str, Any]:
+    reports_records = campaign_level_reports.extended_spend_rows(
+        report_rows(headers, additional)
+    )
+    emit(stream_name, reports_records, campaign_level_reports.flatten)
+    return state
 
-        for record in reports_records:
-            singer.write_record(stream_name, record)
 
-        records_count = len(reports_records)
-        max_report_date = max(record['date'] for record in reports_records)
+def sync_impression_share_reports(
+    state: Dict[str, Any],
+    stream_name: str,
+    headers: auth.RequestHeadersValue,
+    additional: Dict[str, Any],
+) -> Dict[str, Any]:
+    # bookmarks never move past the day the sync started
+    sync_start_date = additional["sync_start_time"].strftime(API_DATE_FORMAT)
+
+    # get current max replication value from state if available, otherwise default to config value
+    current_bookmark_value = singer.get_bookmark(
+        state,
+        stream_name,
+        'date',
+        default=None
+    )
 
-        state = singer.write_bookmark(state, stream_name, 'date', max_report_date)
-        state = singer.write_bookmark(state, stream_name, 'latestRecordCount', records_count)
+    # additional is shared with other streams, overrides stay local
+    if current_bookmark_value is not None:
+        start_time = singer_utils.strptime_to_utc(
+            current_bookmark_value
+        ) + datetime.timedelta(days=1)
+    else:
+        start_time = additional['start_time']
+
+    end_time = additional['end_time']
+    if end_time is None:
+        end_time = additional['default_end_time']
 
-        return state
+    logger.info(f"Start date: {start_time}")
+
+    reports = impression_share_reports.sync(
+        headers,
+        start_time,
+        end_time,
+        "custom_reports_selector",
+    )
+
+    writer = RecordWriter(stream_name)
+    write_record = writer.write
+    records_count = 0
+    # ISO dates compare as strings, and any date is greater than ""
+    max_report_date = ""
+    for reports_records in reports:
+        for record in reports_records:
+            write_record(record)
+            records_count += 1
+            report_date = record['date']
+            if report_date > max_report_date:
+                max_report_date = report_date
+
+        # every record of the report has been written, checkpoint its dates before
+        # the next report is downloaded in case the sync is interrupted
+        if max_report_date:
+            # records must reach stdout before the state that covers them
+            writer.flush()
+            state = write_bookmark(
+                state, stream_name, 'date', min(max_report_date, sync_start_date)
+            )
+            write_state(state)
+
+    writer.flush()
+    state = write_bookmark(state, stream_name, 'latestRecordCount', records_count)
+
+    return state
+
+
+# API endpoint each stream is built from
+STREAM_SOURCES: Dict[str, str] = {
+    "campaign": "campaign",
+    "campaign_flat": "campaign",
+    "campaign_level_reports": "campaign_level_reports",
+    "campaign_level_reports_extended_spend_row": "campaign_level_reports",
+    "campaign_level_reports_extended_spend_row_flat": "campaign_level_reports",
+    "impression_share_reports": "impression_share_reports",
+}
+
+StreamHandler = Callable[
+    [Dict[str, Any], str, auth.RequestHeadersValue, Dict[str, Any]], Dict[str, Any]
+]
 
-    raise TapAppleSearchAdsException("Unknown stream: [{}]".format(stream_name))
+STREAM_HANDLERS: Dict[str, StreamHandler] = {
+    "campaign": sync_campaign,
+    "campaign_flat": sync_campaign_flat,
+    "campaign_level_reports": sync_campaign_level_reports,
+    "campaign_level_reports_extended_spend_row": sync_extended_spend_row,
+    "campaign_level_reports_extended_spend_row_flat": sync_extended_spend_row_flat,
+    "impression_share_reports": sync_impression_share_reports,
+}
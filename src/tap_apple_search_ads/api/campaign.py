@@ -33,6 +33,8 @@ def sync(headers: RequestHeadersValue) -> List[Dict[str, Any]]:
 
 
 def to_schema(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Flattens the record in place and returns the same record, no copy is made."""
+
     budgetAmount = record.pop("budgetAmount")
 
     record["budgetAmount_currency"] = budgetAmount["currency"]
@@ -3,7 +3,7 @@
 import json
 import pathlib
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, Iterator, List
 
 import requests
 import singer
@@ -15,6 +15,13 @@ logger = singer.get_logger()
 
 DEFAULT_URL = "https://api.searchads.apple.com/api/v4/reports/campaigns"
 
+PROPERTIES_TO_SERIALIZE = (
+    "avgCPA",
+    "avgCPM",
+    "avgCPT",
+    "localSpend",
+)
+
 reportsSelector: Dict[str, Any] = {"loaded": False, "data": Dict[str, Any]}
 
 
@@ -32,10 +39,14 @@ def load_selector(selector_name) -> Dict[str, Any]:
 
 
     with open(path, "r") as stream:
-        reportsSelector["loaded"] = True
-        reportsSelector["data"] = json.load(stream)
+        data = json.load(stream)
+
+    # return the loaded selector itself, reportsSelector may already hold the one
+    # loaded by another stream syncing in parallel
+    reportsSelector["loaded"] = True
+    reportsSelector["data"] = data
 
-    return reportsSelector["data"]
+    return data
 
 
 def sync(
@@ -69,15 +80,9 @@ def sync(
     return response.json()["data"]["reportingDataResponse"]["row"]
 
 
-def sync_extended_spend_row(
-    headers: RequestHeadersValue,
-    start_time: datetime,
-    end_time: datetime,
-    selector_name: str,
-) -> List[Dict[str, Any]]:
-    report_rows = sync(headers, start_time, end_time, selector_name)
-    extended_spend_rows: List[Dict[str, Any]] = []
-
+def extended_spend_rows(
+    report_rows: Iterable[Dict[str, Any]]
+) -> Iterator[Dict[str, Any]]:
     for row in report_rows:
         granularity = row["granularity"]
         metadata = row["metadata"]
@@ -85,15 +90,15 @@ def sync_extended_spend_row(
         for granularity_row in granularity:
             extended_spend_row = dict(granularity_row)
             extended_spend_row["campaignId"] = metadata["campaignId"]
-            extended_spend_rows.append(extended_spend_row)
-
-    return extended_spend_rows
+            yield extended_spend_row
 
 
 def flatten(record: Dict[str, Any]) -> Dict[str, Any]:
-    record["avgCPA"] = json.dumps(record["avgCPA"])
-    record["avgCPM"] = json.dumps(record["avgCPM"])
-    record["avgCPT"] = json.dumps(record["avgCPT"])
-    record["localSpend"] = json.dumps(record["localSpend"])
+    """Serializes Money properties of the record in place and returns the same
+    record, no copy is made.
+    """
+
+    for key in PROPERTIES_TO_SERIALIZE:
+        record[key] = json.dumps(record[key])
 
     return record
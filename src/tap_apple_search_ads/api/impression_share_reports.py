@@ -3,7 +3,7 @@ import requests
 import singer
 import csv
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, Tuple
 
 from tap_apple_search_ads import api
 from tap_apple_search_ads.api.auth import RequestHeadersValue
@@ -22,7 +22,11 @@ def sync(
     start_time: datetime,
     end_time: datetime,
     selector_name: str,
-) -> List[Dict[str, Any]]:
+) -> Iterator[Iterator[Dict[str, Any]]]:
+    """Request impression share reports for the date range, then yield the records
+    of each report as a separate iterator, one report at a time. A report is only
+    downloaded once the records of the previous one have been consumed.
+    """
 
     selector = load_selector(selector_name)
     date_ranges = split_date_range(start_time, end_time)
@@ -55,15 +59,11 @@ def sync(
         num_requests_made += 1
         generated_reports.append(report_request_response)
 
-    combined_records = []
     for report in generated_reports:
         # Second, we fetch the report URI if the report is ready
         report_download_uri = fetch_single_impression_share_report(report['report_id'], headers)
         csv_data = fetch_csv_data(report_download_uri)
-        records = to_schema(csv_data, report['report_creation_time'])
-        combined_records.extend(records)
-
-    return combined_records
+        yield to_schema(csv_data, report['report_creation_time'])
 
 def request_impression_share_report(headers: RequestHeadersValue, selector: Dict[str, Any]) -> Dict[str, str]:
     """Request an impression share report for a given date range
@@ -109,17 +109,14 @@ def fetch_csv_data(
 
     return csv.DictReader(response.text.splitlines())
 
-def to_schema(csv_data, report_creation_time) -> List[Dict[str, Any]]:
+def to_schema(csv_data, report_creation_time) -> Iterator[Dict[str, Any]]:
 
-    data = []
     for row in csv_data:
         row["lowImpressionShare"] = float(row["lowImpressionShare"])
         row["highImpressionShare"] = float(row["highImpressionShare"])
         row["searchPopularity"] = int(row["searchPopularity"])
         row['extractedAt'] = report_creation_time
-        data.append(row)
-
-    return data
+        yield row
 
 def fetch_single_impression_share_report(report_id: str, headers: RequestHeadersValue):
 
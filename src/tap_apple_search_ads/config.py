@@ -1,12 +1,19 @@
+import sys
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Any, Mapping
+from typing import Any, Dict, Mapping
 
 import pytz
 import singer
 
 logger = singer.get_logger()
 
+# dataclass(slots=True) is available since Python 3.10, older versions keep the
+# instance __dict__
+DATACLASS_OPTIONS: Dict[str, Any] = (
+    {"slots": True} if sys.version_info >= (3, 10) else {}
+)
+
 
 def default_start_time() -> datetime:
     now = datetime.now(tz=pytz.utc)
@@ -19,7 +26,7 @@ def default_end_time() -> datetime:
     return end_time
 
 
-@dataclass
+@dataclass(**DATACLASS_OPTIONS)
 class Authentication:
     # authentication
     key_id: str
@@ -47,6 +54,9 @@ class Authentication:
     # default selector's name is going to be 'reports_selector'
     selector: str = "reports_selector"
 
+    # number of streams synced in parallel
+    max_sync_workers: int = 4
+
     @classmethod
     def from_mapping(cls, context: Mapping[str, Any]) -> "Authentication":
         self = cls(
@@ -88,4 +98,23 @@ class Authentication:
         if "selector" in context:
             self.selector = context["selector"]
 
+        if "max_sync_workers" in context:
+            self.max_sync_workers = parse_max_sync_workers(context["max_sync_workers"])
+
         return self
+
+
+def parse_max_sync_workers(value: Any) -> int:
+    try:
+        max_sync_workers = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "max_sync_workers must be an integer, got [{}]".format(value)
+        ) from None
+
+    if max_sync_workers < 1:
+        raise ValueError(
+            "max_sync_workers must be at least 1, got [{}]".format(max_sync_workers)
+        )
+
+    return max_sync_workers
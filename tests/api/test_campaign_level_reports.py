@@ -0,0 +1,48 @@
+from types import GeneratorType
+
+from tap_apple_search_ads.api import campaign_level_reports
+
+
+def test_extended_spend_rows():
+    rows = [
+        {
+            "metadata": {"campaignId": 1},
+            "granularity": [{"date": "2023-01-01"}, {"date": "2023-01-02"}],
+        },
+        {
+            "metadata": {"campaignId": 2},
+            "granularity": [{"date": "2023-01-01"}],
+        },
+    ]
+
+    records = campaign_level_reports.extended_spend_rows(rows)
+
+    assert isinstance(records, GeneratorType)
+    assert list(records) == [
+        {"date": "2023-01-01", "campaignId": 1},
+        {"date": "2023-01-02", "campaignId": 1},
+        {"date": "2023-01-01", "campaignId": 2},
+    ]
+    # granularity rows are copied, not modified
+    assert rows[0]["granularity"] == [{"date": "2023-01-01"}, {"date": "2023-01-02"}]
+
+
+def test_flatten_in_place():
+    record = {
+        "avgCPA": {"amount": "1", "currency": "USD"},
+        "avgCPM": {"amount": "2", "currency": "USD"},
+        "avgCPT": {"amount": "3", "currency": "USD"},
+        "localSpend": {"amount": "4", "currency": "USD"},
+        "campaignId": 1,
+    }
+
+    flat = campaign_level_reports.flatten(record)
+
+    assert flat is record
+    assert flat == {
+        "avgCPA": '{"amount": "1", "currency": "USD"}',
+        "avgCPM": '{"amount": "2", "currency": "USD"}',
+        "avgCPT": '{"amount": "3", "currency": "USD"}',
+        "localSpend": '{"amount": "4", "currency": "USD"}',
+        "campaignId": 1,
+    }
@@ -0,0 +1,27 @@
+import pytest
+
+from tap_apple_search_ads import config
+
+CONTEXT = {
+    "key_id": "key_id",
+    "client_id": "client_id",
+    "team_id": "team_id",
+    "org_id": "org_id",
+}
+
+
+def test_max_sync_workers_default():
+    assert config.Authentication.from_mapping(CONTEXT).max_sync_workers == 4
+
+
+@pytest.mark.parametrize("value, expected", [(2, 2), ("8", 8)])
+def test_max_sync_workers(value, expected):
+    context = dict(CONTEXT, max_sync_workers=value)
+    assert config.Authentication.from_mapping(context).max_sync_workers == expected
+
+
+@pytest.mark.parametrize("value", [0, -1, "0", "four", None])
+def test_max_sync_workers_invalid(value):
+    context = dict(CONTEXT, max_sync_workers=value)
+    with pytest.raises(ValueError, match="max_sync_workers"):
+        config.Authentication.from_mapping(context)
@@ -0,0 +1,437 @@
+import copy
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+import tap_apple_search_ads as tap
+
+
+def written_records(capsys):
+    messages = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return [
+        (message["stream"], message["record"])
+        for message in messages
+        if message["type"] == "RECORD"
+    ]
+
+
+def test_stream_handlers_cover_streams():
+    assert set(tap.STREAM_HANDLERS) == set(tap.STREAMS)
+    assert set(tap.STREAM_SOURCES) == set(tap.STREAMS)
+
+
+def test_sync_concrete_stream_unknown_stream():
+    with pytest.raises(tap.TapAppleSearchAdsException):
+        tap.sync_concrete_stream({}, "unknown", mock.sentinel.headers, {})
+
+
+def test_sync_concrete_stream_campaign_flat(capsys):
+    records = [{"id": 1}, {"id": 2}]
+
+    with mock.patch.object(
+        tap.campaign, "sync", return_value=records
+    ), mock.patch.object(
+        tap.campaign, "to_schema", side_effect=lambda record: {"flat": record["id"]}
+    ):
+        state = tap.sync_concrete_stream({}, "campaign_flat", mock.sentinel.headers, {})
+
+    assert state == {}
+    assert written_records(capsys) == [
+        ("campaign_flat", {"flat": 1}),
+        ("campaign_flat", {"flat": 2}),
+    ]
+
+
+def test_sync_concrete_stream_impression_share_reports_checkpoints():
+    reports = [
+        [{"date": "2023-01-02"}, {"date": "2023-01-01"}],
+        [{"date": "2023-01-03"}],
+    ]
+    events = []
+
+    def sync(*args):
+        for i, report in enumerate(reports):
+            events.append("download {}".format(i))
+            yield iter(report)
+
+    additional = {
+        "start_time": mock.sentinel.start_time,
+        "end_time": mock.sentinel.end_time,
+        "sync_start_time": datetime.datetime(2023, 1, 10),
+        "default_end_time": datetime.datetime(2023, 1, 9),
+    }
+    written_states = []
+
+    def write_state(state):
+        events.append("state")
+        written_states.append(copy.deepcopy(state))
+
+    with mock.patch.object(
+        tap.impression_share_reports, "sync", side_effect=sync
+    ), mock.patch.object(tap, "RecordWriter"), mock.patch.object(
+        tap.singer, "write_state", side_effect=write_state
+    ):
+        state = tap.sync_concrete_stream(
+            {}, "impression_share_reports", mock.sentinel.headers, additional
+        )
+
+    assert events == ["download 0", "state", "download 1", "state"]
+    assert written_states == [
+        {"bookmarks": {"impression_share_reports": {"date": "2023-01-02"}}},
+        {"bookmarks": {"impression_share_reports": {"date": "2023-01-03"}}},
+    ]
+    assert state == {
+        "bookmarks": {
+            "impression_share_reports": {"date": "2023-01-03", "latestRecordCount": 3}
+        }
+    }
+
+
+def test_campaign_level_reports_are_fetched_once_per_task(capsys):
+    spend = {"avgCPA": 1, "avgCPM": 2, "avgCPT": 3, "localSpend": 4}
+    rows = [{"metadata": {"campaignId": 1}, "granularity": [spend]}]
+    additional = {
+        "start_time": mock.sentinel.start_time,
+        "end_time": mock.sentinel.end_time,
+        "selector": "reports_selector",
+    }
+    headers = {"Authorization": "Bearer token", "X-AP-Context": "orgId=1"}
+
+    with mock.patch.object(
+        tap.campaign_level_reports, "sync", return_value=rows
+    ) as sync:
+        tap.sync_streams(
+            [
+                ("campaign_level_reports_extended_spend_row_flat", {}, []),
+                ("campaign_level_reports_extended_spend_row", {}, []),
+            ],
+            {},
+            headers,
+            additional,
+        )
+
+    sync.assert_called_once_with(
+        headers, mock.sentinel.start_time, mock.sentinel.end_time, "reports_selector"
+    )
+    assert "fetched" not in additional
+    assert written_records(capsys) == [
+        (
+            "campaign_level_reports_extended_spend_row_flat",
+            {
+                "avgCPA": "1",
+                "avgCPM": "2",
+                "avgCPT": "3",
+                "localSpend": "4",
+                "campaignId": 1,
+            },
+        ),
+        (
+            "campaign_level_reports_extended_spend_row",
+            dict(spend, campaignId=1),
+        ),
+    ]
+
+
+def test_load_private_key_from_file(tmp_path):
+    private_key_file = tmp_path / "private-key.pem"
+    private_key_file.write_text("key\n")
+    config = {"private_key_file": private_key_file.as_posix()}
+
+    with mock.patch.object(
+        tap.auth.utils,
+        "read_private_key_from_file",
+        wraps=tap.auth.utils.read_private_key_from_file,
+    ) as read_private_key_from_file:
+        assert tap.load_private_key(config) == "key"
+        assert tap.load_private_key(config) == "key"
+
+    read_private_key_from_file.assert_called_once()
+
+
+def test_save_and_load_cache(tmp_path):
+    cache_file = tmp_path / "auth"
+    assert tap.load_cache(cache_file) == {}
+
+    tap.save_cache({"access_token_value": (1.0, {"a": 1})}, cache_file)
+
+    assert tap.load_cache(cache_file) == {"access_token_value": (1.0, {"a": 1})}
+
+
+def test_load_cache_unreadable_file(tmp_path):
+    cache_file = tmp_path / "auth"
+    cache_file.write_bytes(b"not a pickle")
+
+    assert tap.load_cache(cache_file) == {}
+
+
+def test_get_or_create_cache_is_reused(tmp_path):
+    with mock.patch.object(tap, "cache", None), mock.patch.object(
+        tap.atexit, "register"
+    ) as register:
+        cache = tap.get_or_create_cache(tmp_path.as_posix(), "auth")
+        assert cache == {}
+        assert tap.get_or_create_cache(tmp_path.as_posix(), "auth") is cache
+
+    register.assert_called_once()
+
+
+def test_record_writer_matches_singer(capsys):
+    record = {"id": 1, "name": "campagne é", "share": 0.5, "budget": None}
+
+    writer = tap.RecordWriter("campaign")
+    writer.write(record)
+    writer.flush()
+    tap.singer.write_record("campaign", record)
+
+    first, second = capsys.readouterr().out.splitlines()
+    assert first == second
+
+
+def test_record_writer_batches(capsys):
+    writer = tap.RecordWriter("campaign", batch_size=2)
+
+    writer.write({"id": 1})
+    assert capsys.readouterr().out == ""
+
+    writer.write({"id": 2})
+    writer.write({"id": 3})
+    assert written_records(capsys) == [("campaign", {"id": 1}), ("campaign", {"id": 2})]
+
+    writer.flush()
+    assert written_records(capsys) == [("campaign", {"id": 3})]
+
+
+def test_sync_concrete_stream_impression_share_reports_keeps_additional():
+    additional = {
+        "start_time": datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc),
+        "end_time": None,
+        "sync_start_time": datetime.datetime(2023, 1, 10),
+        "default_end_time": mock.sentinel.default_end_time,
+    }
+    expected_additional = dict(additional)
+    state = {"bookmarks": {"impression_share_reports": {"date": "2023-01-05"}}}
+
+    with mock.patch.object(
+        tap.impression_share_reports, "sync", return_value=iter([])
+    ) as sync:
+        tap.sync_concrete_stream(
+            state, "impression_share_reports", mock.sentinel.headers, additional
+        )
+
+    sync.assert_called_once_with(
+        mock.sentinel.headers,
+        datetime.datetime(2023, 1, 6, tzinfo=datetime.timezone.utc),
+        mock.sentinel.default_end_time,
+        "custom_reports_selector",
+    )
+    assert additional == expected_additional
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        {"lowImpressionShare": float("nan")},
+        {"granularity": [{"avgCPA": float("inf")}]},
+    ],
+)
+def test_record_writer_rejects_non_finite_floats(record):
+    writer = tap.RecordWriter("impression_share_reports")
+
+    with pytest.raises(ValueError):
+        writer.write(record)
+
+    with pytest.raises(ValueError):
+        tap.singer.write_record("impression_share_reports", record)
+
+
+CONFIG = {
+    "key_id": "key_id",
+    "client_id": "client_id",
+    "team_id": "team_id",
+    "org_id": "org_id",
+    "private_key_value": "private_key",
+}
+
+HEADERS = {"Authorization": "Bearer token", "X-AP-Context": "orgId=org_id"}
+
+
+def catalog(*streams):
+    return tap.singer.Catalog.from_dict(
+        {
+            "streams": [
+                {
+                    "stream": stream_name,
+                    "tap_stream_id": stream_name,
+                    "schema": {"type": "object"},
+                    "metadata": [
+                        {"breadcrumb": [], "metadata": {"selected": selected}}
+                    ],
+                }
+                for stream_name, selected in streams
+            ]
+        }
+    )
+
+
+@pytest.fixture
+def authentication():
+    client_secret, access_token, request_headers = (
+        mock.Mock(),
+        mock.Mock(),
+        mock.Mock(),
+    )
+    request_headers.value.return_value = HEADERS
+
+    with mock.patch.object(
+        tap,
+        "set_up_authentication",
+        return_value=(client_secret, access_token, request_headers),
+    ):
+        yield
+
+
+def test_do_sync(authentication, capsys):
+    spend = {"avgCPA": 1, "avgCPM": 2, "avgCPT": 3, "localSpend": 4}
+    rows = [{"metadata": {"campaignId": 1}, "granularity": [spend]}]
+    calls = []
+    fetched = {}
+    sync_concrete_stream = tap.sync_concrete_stream
+
+    def record_call(state, stream_name, headers, additional):
+        calls.append((stream_name, threading.get_ident()))
+        fetched[stream_name] = additional["fetched"]
+        return sync_concrete_stream(state, stream_name, headers, additional)
+
+    with mock.patch.object(
+        tap, "sync_concrete_stream", side_effect=record_call
+    ), mock.patch.object(
+        tap.campaign, "sync", return_value=[{"id": 1}]
+    ), mock.patch.object(
+        tap.campaign_level_reports, "sync", return_value=rows
+    ) as campaign_level_reports_sync:
+        tap.do_sync(
+            CONFIG,
+            catalog(
+                ("campaign_level_reports", True),
+                ("campaign", True),
+                ("campaign_flat", False),
+                ("campaign_level_reports_extended_spend_row", True),
+                ("campaign_level_reports_extended_spend_row_flat", True),
+            ),
+            {},
+        )
+
+    # unselected streams are skipped
+    assert {stream_name for stream_name, _ in calls} == {
+        "campaign",
+        "campaign_level_reports",
+        "campaign_level_reports_extended_spend_row",
+        "campaign_level_reports_extended_spend_row_flat",
+    }
+
+    # streams of the same source run in catalog order, in a single task
+    report_calls = [call for call in calls if call[0] != "campaign"]
+    assert [stream_name for stream_name, _ in report_calls] == [
+        "campaign_level_reports",
+        "campaign_level_reports_extended_spend_row",
+        "campaign_level_reports_extended_spend_row_flat",
+    ]
+    assert len({thread for _, thread in report_calls}) == 1
+
+    # the report is fetched once, into a cache local to its task
+    campaign_level_reports_sync.assert_called_once()
+    assert (
+        fetched["campaign_level_reports"]
+        is fetched["campaign_level_reports_extended_spend_row"]
+        is fetched["campaign_level_reports_extended_spend_row_flat"]
+    )
+    assert fetched["campaign"] is not fetched["campaign_level_reports"]
+    assert fetched["campaign"] == {}
+
+    # every stream's SCHEMA is written before its RECORDs
+    messages = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    schemas = set()
+    records = set()
+    for message in messages:
+        if message["type"] == "SCHEMA":
+            schemas.add(message["stream"])
+        elif message["type"] == "RECORD":
+            assert message["stream"] in schemas
+            records.add(message["stream"])
+
+    assert records == {stream_name for stream_name, _ in calls}
+
+
+def test_do_sync_unknown_stream(authentication):
+    with mock.patch.object(tap, "sync_streams") as sync_streams:
+        with pytest.raises(tap.TapAppleSearchAdsException):
+            tap.do_sync(CONFIG, catalog(("campaign", True), ("unknown", True)), {})
+
+    sync_streams.assert_not_called()
+
+
+def test_main_buffers_records_until_state(tmp_path, monkeypatch):
+    output = tmp_path / "stdout"
+    args = mock.Mock(discover=False, catalog=mock.sentinel.catalog, state=None)
+
+    def do_sync(config, catalog, state):
+        writer = tap.RecordWriter("campaign")
+        writer.write({"id": 1})
+        writer.flush()
+        sys.stdout.write("é\n")
+
+        # written without a flush, nothing has reached the file yet
+        assert output.read_bytes() == b""
+
+        tap.singer.write_state({"bookmarks": {}})
+
+        return 0
+
+    with open(output, "w", encoding="ascii") as stdout:
+        monkeypatch.setattr(sys, "stdout", stdout)
+
+        with mock.patch.object(
+            tap.singer.utils, "parse_args", return_value=args
+        ), mock.patch.object(tap, "do_sync", side_effect=do_sync):
+            assert tap.main() == 0
+
+    assert output.read_bytes().decode("utf-8").splitlines() == [
+        '{"type": "RECORD", "stream": "campaign", "record": {"id": 1}}',
+        "é",
+        '{"type": "STATE", "value": {"bookmarks": {}}}',
+    ]
+
+
+def test_main_flushes_records_at_exit():
+    script = "\n".join(
+        [
+            "from unittest import mock",
+            "import tap_apple_search_ads as tap",
+            "args = mock.Mock(discover=False, catalog=True, state=None)",
+            "def do_sync(config, catalog, state):",
+            "    writer = tap.RecordWriter('campaign')",
+            "    writer.write({'name': 'é'})",
+            "    writer.flush()",
+            "    print('é')",
+            "    return 0",
+            "tap.singer.utils.parse_args = mock.Mock(return_value=args)",
+            "tap.do_sync = do_sync",
+            "tap.main()",
+        ]
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+    result = subprocess.run(
+        [sys.executable, "-c", script], env=env, stdout=subprocess.PIPE, check=True
+    )
+
+    assert result.stdout.decode("utf-8").splitlines() == [
+        '{"type": "RECORD", "stream": "campaign", "record": {"name": "\\u00e9"}}',
+        "é",
+    ]